@@ -0,0 +1,176 @@
+######
+#
+# This script bulk loads staged rows into the fics database.
+#
+# Usage - python ao3_bulk_load.py STAGE_DIR
+#
+# ao3_get_fanfics.py and ao3_get_comments.py take --stage STAGE_DIR, which makes
+# them append rows to tab separated files there instead of inserting them one
+# at a time. This script then loads each file with a single LOAD DATA LOCAL INFILE:
+#   works.tsv, chaps.tsv, comments.tsv  rows of the table of the same name
+#   work_tags.tsv                       (work id, tag type, tag name), interned into tags/work_tags
+#
+# ao3_get_fanfics.py skips works already staged, and stages a work's row only
+# after its chapters, so an interrupted run can be restarted before loading.
+#
+# Non-unique indexes of the loaded tables are dropped before the load and built
+# again after it. Rows skipped as duplicates or malformed are counted, and the
+# server's warnings about them are written to STAGE_DIR/<table>_rejects.txt.
+# Loaded files are renamed to <name>.loaded so they aren't loaded twice.
+#
+# The server needs local_infile enabled (SET GLOBAL local_infile = 1).
+#######
+import argparse
+import os
+import mysql.connector
+
+# tables in the order they are loaded
+tables = ['works', 'work_tags', 'chaps', 'comments']
+
+def format_value(value):
+    '''
+    formats a value for LOAD DATA's default format: NULL is \\N,
+    and backslashes, tabs and newlines are escaped
+    '''
+    if value is None:
+        return "\\N"
+    value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r").replace("\0", "\\0")
+
+def stage_row(stage_dir, table, val):
+    '''
+    appends a row for table to its staged file
+    '''
+    with open(os.path.join(stage_dir, table + ".tsv"), "a", encoding="utf-8", newline="") as f_out:
+        f_out.write("\t".join(format_value(value) for value in val) + "\n")
+
+def get_secondary_indexes(cursor, table):
+    '''
+    returns (name, ADD clause) for the non-unique indexes of a table
+    '''
+    sql = "SELECT INDEX_NAME, INDEX_TYPE, COLUMN_NAME, SUB_PART FROM information_schema.STATISTICS " \
+          "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND NON_UNIQUE = 1 " \
+          "ORDER BY INDEX_NAME, SEQ_IN_INDEX"
+    cursor.execute(sql, (table, ))
+    indexes = {}
+    kinds = {}
+    for name, kind, column, sub_part in cursor.fetchall():
+        column = "`" + column + "`"
+        if sub_part: column = column + "(" + str(sub_part) + ")"
+        indexes.setdefault(name, []).append(column)
+        kinds[name] = kind
+    clauses = []
+    for name, columns in indexes.items():
+        kind = "FULLTEXT INDEX" if kinds[name] == "FULLTEXT" else "INDEX"
+        clauses.append((name, "ADD " + kind + " `" + name + "` (" + ", ".join(columns) + ")"))
+    return clauses
+
+def drop_indexes(cursor, table):
+    '''
+    drops the non-unique indexes of a table, returning the clauses to add them back
+    '''
+    dropped = []
+    for name, clause in get_secondary_indexes(cursor, table):
+        try:
+            cursor.execute("ALTER TABLE " + table + " DROP INDEX `" + name + "`")
+            dropped.append(clause)
+        except mysql.connector.Error as e:
+            # e.g. the index backs a foreign key; leave it in place
+            print("Keeping index", name, "on", table + ":", e)
+    return dropped
+
+def load_file(cursor, path, table):
+    '''
+    loads a staged file into table, returns (rows in file, rows inserted, warnings)
+    '''
+    with open(path, "r", encoding="utf-8", newline="") as f_in:
+        lines = sum(1 for line in f_in)
+    sql = "LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE " + table + " CHARACTER SET utf8mb4"
+    cursor.execute(sql, (path, ))
+    inserted = cursor.rowcount
+    cursor.execute("SHOW WARNINGS")
+    warnings = cursor.fetchall()
+    return lines, inserted, warnings
+
+def load_work_tags(cursor, path):
+    '''
+    loads (work id, type, name) rows through a temporary table,
+    interning new tags and linking them to their works
+    '''
+    cursor.execute("CREATE TEMPORARY TABLE staged_work_tags (work_id INT, type VARCHAR(16), name VARCHAR(255))")
+    lines, _, warnings = load_file(cursor, path, "staged_work_tags")
+    # only insert tags that aren't there yet: an ignored duplicate
+    # still uses up an auto increment id
+    cursor.execute("INSERT IGNORE INTO tags (type, name) SELECT DISTINCT s.type, s.name FROM staged_work_tags s "
+                   "LEFT JOIN tags t ON t.type = s.type AND t.name = s.name WHERE t.id IS NULL")
+    cursor.execute("SHOW WARNINGS")
+    warnings = warnings + cursor.fetchall()
+    cursor.execute("INSERT IGNORE INTO work_tags (work_id, tag_id) SELECT s.work_id, t.id FROM staged_work_tags s "
+                   "JOIN tags t ON t.type = s.type AND t.name = s.name")
+    inserted = cursor.rowcount
+    # duplicate links skipped here are reported like the ones skipped by LOAD DATA
+    cursor.execute("SHOW WARNINGS")
+    warnings = warnings + cursor.fetchall()
+    cursor.execute("DROP TEMPORARY TABLE staged_work_tags")
+    return lines, inserted, warnings
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Bulk load rows staged by ao3_get_fanfics.py and ao3_get_comments.py.')
+    parser.add_argument(
+        'stage_dir', metavar='STAGE_DIR',
+        help='folder the scrapers staged their rows in')
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    stage_dir = args.stage_dir
+
+    # connect to database
+    db = mysql.connector.connect(
+        host = "localhost",
+        user = "root",
+        password = "password",
+        database = "fics",
+        allow_local_infile = True
+    )
+    cursor = db.cursor()
+
+    to_load = [table for table in tables if os.path.exists(os.path.join(stage_dir, table + ".tsv"))]
+    if not to_load:
+        print("Nothing staged in", stage_dir)
+        return
+
+    # building indexes once at the end is much faster than updating them per row
+    dropped = {}
+    for table in to_load:
+        dropped[table] = drop_indexes(cursor, table)
+
+    try:
+        for table in to_load:
+            path = os.path.join(stage_dir, table + ".tsv")
+            print("Loading", path)
+            if table == 'work_tags':
+                lines, inserted, warnings = load_work_tags(cursor, path)
+            else:
+                lines, inserted, warnings = load_file(cursor, path, table)
+            db.commit()
+            os.rename(path, path + ".loaded")
+
+            print(table + ":", inserted, "rows loaded,", lines - inserted, "skipped as duplicates or malformed")
+            if warnings:
+                # the server keeps at most max_error_count warnings
+                with open(os.path.join(stage_dir, table + "_rejects.txt"), "a", encoding="utf-8") as f_rejects:
+                    for level, code, message in warnings:
+                        f_rejects.write(level + " " + str(code) + ": " + message + "\n")
+                print("   see", os.path.join(stage_dir, table + "_rejects.txt"))
+    finally:
+        # put the indexes back even if a load failed
+        for table in to_load:
+            if dropped[table]:
+                print("Rebuilding indexes on", table)
+                cursor.execute("ALTER TABLE " + table + " " + ", ".join(dropped[table]))
+
+    print("Done.")
+
+if __name__ == '__main__':
+    main()
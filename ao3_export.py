@@ -0,0 +1,217 @@
+######
+#
+# This script exports the fics database to a folder of text files,
+# one per work, and a csv of the metadata of those works.
+# (Replaces extract_metadata.py and csv_to_txts.py, which worked on the old csv output.)
+#
+# Usage - python ao3_export.py OUT_DIR
+#
+# Rows are streamed from MySQL in chunks, never the whole table at once,
+# and the text files are written by a pool of worker processes.
+#
+# --fandom, --language, --tag restrict the export to works matching them
+#   (--fandom and --tag use the tags/work_tags tables, run
+#   ao3_tag_counts.py --backfill first for works scraped before they existed)
+# --processes sets the number of worker processes (default: all cores)
+# --batch sets how many works each worker handles at a time
+#
+# Progress is saved to OUT_DIR/progress.txt after every finished batch,
+# so running the same command again picks up where it stopped.
+#######
+import argparse
+import csv
+import os
+from collections import deque
+from multiprocessing import Pool, cpu_count
+import mysql.connector
+
+# rows fetched from the server at a time
+chunk_size = 1000
+
+# per-process database connection, opened by the pool initializer
+db = None
+
+def connect():
+    return mysql.connector.connect(
+        host = "localhost",
+        user = "root",
+        password = "password",
+        database = "fics"
+    )
+
+def init_worker():
+    global db
+    db = connect()
+
+def get_where(fandom, language, tag):
+    '''
+    returns the WHERE clause (without the id condition) and its values for the filters
+    '''
+    # tags are matched exactly through tags/work_tags, not with LIKE on the
+    # comma joined columns, where "Fluff" would also match "Fluff and Angst"
+    clauses = []
+    vals = []
+    if fandom:
+        clauses.append("EXISTS (SELECT 1 FROM work_tags wt JOIN tags t ON t.id = wt.tag_id "
+                       "WHERE wt.work_id = works.id AND t.type = 'fandom' AND t.name = %s)")
+        vals.append(fandom)
+    if language:
+        clauses.append("language = %s")
+        vals.append(language)
+    if tag:
+        clauses.append("EXISTS (SELECT 1 FROM work_tags wt JOIN tags t ON t.id = wt.tag_id "
+                       "WHERE wt.work_id = works.id AND t.name = %s)")
+        vals.append(tag)
+    return clauses, vals
+
+def stream_ids(cursor, last_id, fandom, language, tag):
+    '''
+    yields the ids of matching works after last_id, in id order, chunk_size at a time
+    '''
+    clauses, vals = get_where(fandom, language, tag)
+    clauses.insert(0, "id > %s")
+    vals.insert(0, last_id)
+    sql = "SELECT id FROM works WHERE " + " AND ".join(clauses) + " ORDER BY id"
+    # the default cursor is unbuffered, so rows stay on the server until fetched
+    cursor.execute(sql, vals)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row[0]
+
+def batches(ids, size):
+    batch = []
+    for fic_id in ids:
+        batch.append(fic_id)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def export_batch(out_dir, fic_ids):
+    '''
+    runs in a worker: writes one text file per work in the batch.
+    returns the metadata rows of the batch, for the main process to write
+    '''
+    cursor = db.cursor()
+    placeholders = ", ".join(["%s"] * len(fic_ids))
+
+    cursor.execute("SELECT * FROM works WHERE id IN (" + placeholders + ") ORDER BY id", fic_ids)
+    meta = cursor.fetchall()
+
+    # chaps rows are (fic id, chapter number, title, summary, notes, end notes, text)
+    cursor.execute("SELECT * FROM chaps WHERE fic_id IN (" + placeholders + ") ORDER BY fic_id, 2", fic_ids)
+    current = None
+    f_out = None
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            if row[0] != current:
+                if f_out: f_out.close()
+                current = row[0]
+                f_out = open(os.path.join(out_dir, str(current) + ".txt"), "w", encoding="utf-8")
+            if row[2]:
+                f_out.write(row[2].strip() + "\n\n")
+            f_out.write((row[6] or "") + "\n\n")
+    if f_out: f_out.close()
+    cursor.close()
+    return meta
+
+def write_progress(progress_name, last_id, meta_size):
+    '''
+    records the last exported work and the size of metadata.csv up to it.
+    written to a temporary file and renamed, so it's never half written
+    '''
+    with open(progress_name + ".tmp", "w") as f_progress:
+        f_progress.write(str(last_id) + " " + str(meta_size))
+    os.replace(progress_name + ".tmp", progress_name)
+
+def finish_batch(batch, metawriter, f_meta, meta_name, progress_name):
+    '''
+    waits for a batch, writes its metadata and moves progress past it.
+    returns the number of works in it
+    '''
+    batch_last, result = batch
+    meta = result.get()
+    metawriter.writerows(meta)
+    f_meta.flush()
+    write_progress(progress_name, batch_last, os.path.getsize(meta_name))
+    return len(meta)
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Export the fics database to text files and a metadata csv.')
+    parser.add_argument(
+        'out_dir', metavar='OUT_DIR',
+        help='folder to write the text files, metadata.csv and progress.txt to')
+    parser.add_argument(
+        '--fandom', default='',
+        help='only export works in this fandom')
+    parser.add_argument(
+        '--language', default='',
+        help='only export works in this language, as written on AO3')
+    parser.add_argument(
+        '--tag', default='',
+        help='only export works with this tag, of any kind')
+    parser.add_argument(
+        '--processes', default=cpu_count(),
+        help='number of worker processes')
+    parser.add_argument(
+        '--batch', default=200,
+        help='works per worker task')
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    out_dir = args.out_dir
+    processes = int(args.processes)
+    os.makedirs(out_dir, exist_ok=True)
+
+    main_db = connect()
+    cursor = main_db.cursor()
+
+    progress_name = os.path.join(out_dir, "progress.txt")
+    meta_name = os.path.join(out_dir, "metadata.csv")
+    last_id = 0
+    if os.path.exists(progress_name):
+        with open(progress_name, "r") as f_progress:
+            last_id, meta_size = f_progress.read().split()
+        last_id = int(last_id)
+        # drop metadata rows written after the last recorded batch,
+        # they'll be written again
+        with open(meta_name, "r+b") as f_meta:
+            f_meta.truncate(int(meta_size))
+        print("Resuming after work", last_id)
+    else:
+        cursor.execute("SELECT * FROM works LIMIT 0")
+        cursor.fetchall()
+        with open(meta_name, "w", newline="", encoding="utf-8") as f_meta:
+            csv.writer(f_meta).writerow([column[0] for column in cursor.description])
+        write_progress(progress_name, 0, os.path.getsize(meta_name))
+
+    ids = stream_ids(cursor, last_id, args.fandom, args.language, args.tag)
+
+    exported = 0
+    with open(meta_name, "a", newline="", encoding="utf-8") as f_meta, \
+         Pool(processes, initializer=init_worker) as pool:
+        metawriter = csv.writer(f_meta)
+        # keep a bounded number of batches in flight, and collect them in order
+        # so progress.txt only ever moves past fully written batches
+        pending = deque()
+        for batch in batches(ids, int(args.batch)):
+            pending.append((batch[-1], pool.apply_async(export_batch, (out_dir, batch))))
+            while len(pending) > processes * 2 or (pending and pending[0][1].ready()):
+                exported = exported + finish_batch(pending.popleft(), metawriter, f_meta, meta_name, progress_name)
+                print("Exported", exported, "works")
+        while pending:
+            exported = exported + finish_batch(pending.popleft(), metawriter, f_meta, meta_name, progress_name)
+            print("Exported", exported, "works")
+
+    print("Done.", exported, "works exported.")
+
+if __name__ == '__main__':
+    main()
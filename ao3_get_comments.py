@@ -6,6 +6,21 @@ import csv
 from datetime import datetime
 from unidecode import unidecode
 import mysql.connector
+import os
+from ao3_bulk_load import stage_row
+
+# if set, rows are appended to files here for ao3_bulk_load.py instead of inserted
+stage_dir = ''
+
+# saves a comments row, or stages it for ao3_bulk_load.py
+def insert_comment(db, cursor, sql, val):
+    if stage_dir:
+        stage_row(stage_dir, 'comments', val)
+        return
+    cursor.execute(sql, val)
+
+    # save to db after each comment
+    db.commit()
 
 # returns ID of the comment and saves it to database
 def get_single_comment(db, cursor, ficid, comment, parentID):
@@ -13,24 +28,22 @@ def get_single_comment(db, cursor, ficid, comment, parentID):
     commentid = comment['id'].split('_')[1]
 
     # check if comment already in db, if so, pass
-    sql = "SELECT COUNT(*) FROM fics.comments WHERE id = %s"
-    val = (commentid, )
-    cursor.execute(sql, val)
-    if cursor.fetchone()[0] > 0:
-        print("Duplicate work:", commentid)
-        return
+    # (when staging, ao3_bulk_load.py skips duplicates instead)
+    if not stage_dir:
+        sql = "SELECT COUNT(*) FROM fics.comments WHERE id = %s"
+        val = (commentid, )
+        cursor.execute(sql, val)
+        if cursor.fetchone()[0] > 0:
+            print("Duplicate work:", commentid)
+            return
     
     print("Scraping comment ID:", commentid)
 
     # if no header, probably a deleted comment
     if comment.find('h4', class_='heading byline') == None:
-        sql = "INSERT INTO comments (fic_id, id, parent_id) VALUES (%s, %s, %s)"
-        val = (ficid, commentid, parentID)
-        print("Deleted comment:", val)
-        cursor.execute(sql, val)
-
-        # save to db after each comment
-        db.commit()
+        print("Deleted comment:", (ficid, commentid, parentID))
+        sql = "INSERT INTO comments VALUES (%s, %s, %s, %s, %s, %s, %s)"
+        insert_comment(db, cursor, sql, (ficid, commentid, None, None, None, parentID, None))
 
         return commentid
     
@@ -76,10 +89,7 @@ def get_single_comment(db, cursor, ficid, comment, parentID):
     sql = "INSERT INTO comments VALUES (%s, %s, %s, %s, %s, %s, %s)"
     val = (ficid, commentid, chapternumber, username, dateObj, parentID, text)
     print(val)
-    cursor.execute(sql, val)
-
-    # save to db after each comment
-    db.commit()
+    insert_comment(db, cursor, sql, val)
 
     return commentid
 
@@ -177,9 +187,9 @@ def get_all_comments(db, cursor, ficid, restart_pagenum):
     if (soup.find('ol', class_='pagination actions')):
         # get max page num
         numpages = int(soup.find('ol', class_='pagination actions').findChildren("li", recursive=False)[-2].text)
-        # get comments for each page
-        for i in range(numpages):
-            get_comment_page(db, cursor, ficid, restart_pagenum + i)
+        # get comments for each page, from the one to restart at
+        for i in range(restart_pagenum, numpages + 1):
+            get_comment_page(db, cursor, ficid, i)
             
     # if only one page of comments
     else:
@@ -195,14 +205,17 @@ def get_args():
         '--restart', default='', 
         help='work_id to start at from within a csv')
     parser.add_argument(
-        '--page', default=0, 
-        help='page number to restart from')
+        '--page', default=1, 
+        help='page number to restart from (of the first work scraped)')
+    parser.add_argument(
+        '--stage', default='',
+        help='folder to write rows to for ao3_bulk_load.py, instead of inserting them one at a time')
     args = parser.parse_args()
     fic_ids = args.ids
     is_csv = (len(fic_ids) == 1 and '.csv' in fic_ids[0]) 
     restart = str(args.restart)
-    page = args.page
-    return fic_ids, restart, is_csv, page
+    page = int(args.page)
+    return fic_ids, restart, is_csv, page, args.stage
 
 def main():
      # connect to database
@@ -214,35 +227,37 @@ def main():
     )
     cursor = db.cursor()
 
-    fic_ids, restart, is_csv, page = get_args()
+    global stage_dir
+    fic_ids, restart, is_csv, page, stage_dir = get_args()
+    if stage_dir:
+        os.makedirs(stage_dir, exist_ok=True)
     
-    if not is_csv:
-        print("Not csv")
-        print("Page arg:", page)
-        get_all_comments(db, cursor, fic_ids[0])
-        return
+    if is_csv:
+        with open(fic_ids[0], "r+", newline="") as f_in:
+            ids = []
+            for row in csv.reader(f_in):
+                if not row: continue
+                # csv values are strings, skip e.g. a header row
+                if not row[0].isdigit():
+                    print("Row without a work id:", row)
+                    continue
+                ids.append(row[0])
+    else:
+        ids = fic_ids
 
     start = False
     if restart == '': start = True
     
-    with open(fic_ids[0], "r+", newline="") as f_in:
-        print("CSV")
-        reader = csv.reader(f_in)
-        for row in reader:
-            if type(row[0]) != int:
-                print("Row not of type int:", row)
-                continue
-            print("Page:", page)
-            if not row: continue
-            
-            # ignore until we reach row to restart scrape from
-            if not start:
-                if row[0] != restart: continue
-                start = True
-            
-            # get all comments for fic id
-            get_all_comments(db, cursor, row[0], page)
-            page = 1
+    for fic_id in ids:
+        # ignore until we reach row to restart scrape from
+        if not start:
+            if fic_id != restart: continue
+            start = True
+        
+        print("Page:", page)
+        # get all comments for fic id
+        get_all_comments(db, cursor, fic_id, page)
+        page = 1
     
 
 main()
\ No newline at end of file
@@ -14,6 +14,26 @@
 # --restart is an optional string which when used in combination with a csv input will start
 # the scraping from the given work_id, skipping all previous rows in the csv
 #
+# --refresh-wips re-checks works already in the db whose status is "Updated"
+# and only downloads the chapters added since they were scraped.
+# Without IDs it re-checks every such work in the db.
+#
+# --priority, --large_words and --large_every reorder a csv input using the
+# words, chapters, kudos and updated columns written by ao3_work_ids.py
+#
+# Tags are also saved one row per tag, see ao3_tag_counts.py for the tables
+#
+# --stage writes rows to tab separated files for ao3_bulk_load.py instead of
+# inserting them, for seeding a new database from a big crawl
+#
+# Tables (the other scripts in this repo use these column names too):
+#   CREATE TABLE works (id INT PRIMARY KEY, title VARCHAR(255), author TEXT,
+#                       rating TEXT, category TEXT, fandom TEXT, relationship TEXT, `character` TEXT, freeform TEXT,
+#                       language VARCHAR(64), published DATE, status VARCHAR(16), status_date DATE,
+#                       words INT, chapters VARCHAR(16), comments INT, kudos INT, bookmarks INT, hits INT)
+#   CREATE TABLE chaps (fic_id INT, chapter INT, title TEXT, summary TEXT, notes TEXT, endnotes TEXT,
+#                       text MEDIUMTEXT, PRIMARY KEY (fic_id, chapter))
+#
 # Author: Jingyi Li soundtracknoon [at] gmail
 # I wrote this in Python 2.7. 9/23/16
 # Updated 2/13/18 (also Python3 compatible)
@@ -22,13 +42,23 @@ import requests
 from bs4 import BeautifulSoup
 import argparse
 import csv
+import os
 from unidecode import unidecode
 import mysql.connector
 from time import sleep
+from ao3_bulk_load import stage_row
 
 # seconds to wait between page requests
 delay = 2
 
+# if set, rows are appended to files here for ao3_bulk_load.py instead of inserted
+stage_dir = ''
+# ids of works staged there and not loaded yet
+staged_ids = set()
+
+# tag types, in the order of the works table columns
+tag_types = ['rating', 'category', 'fandom', 'relationship', 'character', 'freeform']
+
     
 def get_stats(meta):
     '''
@@ -74,8 +104,29 @@ def get_tags(meta):
     returns a list of lists, of
     rating, category, fandom, pairing, characters, additional_tags
     '''
-    tags = ['rating', 'category', 'fandom', 'relationship', 'character', 'freeform']
-    return list(map(lambda tag: get_tag_info(tag, meta), tags))
+    return list(map(lambda tag: get_tag_info(tag, meta), tag_types))
+
+def write_tags(cursor, fic_id, tags):
+    '''
+    given the lists from get_tags, interns each tag in the tags table
+    and links it to the work in work_tags
+    '''
+    rows = list(dict.fromkeys((tag_type, name) for tag_type, names in zip(tag_types, tags) for name in names))
+    if not rows:
+        return
+    placeholders = ", ".join(["(%s, %s)"] * len(rows))
+    flat = [item for row in rows for item in row]
+
+    # only insert tags that aren't there yet: an ignored duplicate
+    # still uses up an auto increment id
+    cursor.execute("SELECT type, name FROM tags WHERE (type, name) IN (" + placeholders + ")", flat)
+    existing = set(tuple(row) for row in cursor.fetchall())
+    new = [row for row in rows if row not in existing]
+    if new:
+        cursor.executemany("INSERT IGNORE INTO tags (type, name) VALUES (%s, %s)", new)
+
+    sql = "INSERT IGNORE INTO work_tags (work_id, tag_id) SELECT %s, id FROM tags WHERE (type, name) IN (" + placeholders + ")"
+    cursor.execute(sql, [fic_id] + flat)
 
 # get kudos
 def get_kudos(meta):
@@ -104,6 +155,23 @@ def get_authors(meta):
 
     return authors
 
+# summary, notes and end notes of a chapter after the first
+def get_chapter_notes(chapter):
+    summary = chapter.select_one("div[id=summary]")
+    if summary: summary = summary.text
+    
+    notes = chapter.select_one("div[id=notes]")
+    if notes: notes = notes.text
+    
+    endnotes = chapter.select_one(".end.notes.module")
+    if endnotes: endnotes = endnotes.text
+    return summary, notes, endnotes
+
+def get_chapter_text(chapter):
+    body = chapter.select_one(".userstuff.module")
+    lines = body.select("p")
+    return "\n".join([unidecode(line.text) for line in lines])
+
 def access_denied(soup):
     if (soup.find(class_="flash error")):
         return True
@@ -111,7 +179,127 @@ def access_denied(soup):
         return True
     return False
 
-def write_fic_to_db(fic_id, errorwriter):    
+def get_page(url, fic_id, errorwriter):
+    '''
+    returns the soup for a url, or None if AO3 answered with an error
+    '''
+    # if rate-limited, wait a minute
+    status = 429
+    while 429 == status:
+        req = requests.get(url)
+        status = req.status_code
+        if 429 == status:
+            print("Request answered with Status-Code 429")
+            print("Trying again in 1 minute...")
+            sleep(60)
+    # for other errors, write out to csv and pass
+    if 400 <= status:
+        print("Error scraping ", fic_id, "Status ", str(status))
+        errorwriter.writerow([fic_id] + [status])
+        return None
+    return BeautifulSoup(req.text, 'html.parser')
+
+def is_wip(cursor, fic_id):
+    sql = "SELECT status FROM fics.works WHERE id = %s"
+    cursor.execute(sql, (fic_id, ))
+    row = cursor.fetchone()
+    return bool(row) and row[0] == "Updated"
+
+def get_chapter_ids(soup):
+    '''
+    returns the AO3 ids of a work's chapters, in order, from the chapter index
+    dropdown on a chapter page (empty for single-chapter works)
+    '''
+    select = soup.find("select", id="selected_id")
+    if not select:
+        return []
+    return [option["value"] for option in select.find_all("option")]
+
+def refresh_wip(db, cursor, fic_id, errorwriter):
+    '''
+    for a work already in the db that is still being updated, fetch only the
+    chapters posted since the last scrape instead of the full work,
+    then update its stats and tags in works and work_tags
+    '''
+    print('Refreshing ', fic_id)
+    # without view_full_work this is just the first chapter
+    url = 'http://archiveofourown.org/works/'+str(fic_id)+'?view_adult=true'
+    soup = get_page(url, fic_id, errorwriter)
+    if soup is None:
+        return
+    if (access_denied(soup)):
+        print('Access Denied')
+        return
+
+    meta = soup.find("dl", class_="work meta group")
+    tags = get_tags(meta)
+    stats = get_stats(meta)
+    if stats[4] == "": stats[4] = "0"
+    if stats[6] == "null": stats[6] = "0"
+    if stats[8] == "null": stats[8] = "0"
+
+    cursor.execute("SELECT COUNT(*) FROM fics.chaps WHERE fic_id = %s", (fic_id, ))
+    stored = cursor.fetchone()[0]
+    # chapters stat is "posted/planned", e.g. "5/?"
+    current = int(stats[5].split("/")[0].replace(',', ''))
+
+    if current > stored:
+        chapter_ids = get_chapter_ids(soup)
+        if len(chapter_ids) < current:
+            print("Could not find chapter index for", fic_id)
+            return
+        sql = "INSERT INTO chaps VALUES (%s, %s, %s, %s, %s, %s, %s)"
+        for i in range(stored, current):
+            sleep(delay)
+            url = 'http://archiveofourown.org/works/'+str(fic_id)+'/chapters/'+chapter_ids[i]+'?view_adult=true'
+            print(url)
+            page = get_page(url, fic_id, errorwriter)
+            if page is None:
+                # keep what we have; the stats are left alone so the next run retries
+                db.commit()
+                return
+            chapter = page.select_one("div[id^=chapter-]")
+            title = chapter.select_one(".title")
+            if title: title = title.text
+            # first chapter has extra info in different place, as in write_fic_to_db
+            if i == 0:
+                summary = page.select_one(".summary.module")
+                if summary: summary = summary.text
+
+                notes = page.select_one(".notes.module")
+                if notes: notes = notes.text
+
+                endnotes = page.select_one(".end.notes.module")
+                if endnotes: endnotes = endnotes.text
+            else:
+                summary, notes, endnotes = get_chapter_notes(chapter)
+            text = get_chapter_text(chapter)
+            cursor.execute(sql, (fic_id, i + 1, title, summary, notes, endnotes, text))
+        print("Added chapters", stored + 1, "to", current)
+    elif current < stored:
+        print("Work", fic_id, "has fewer chapters than stored, leaving chapters as they are")
+
+    #     tags = ['rating', 'category', 'fandom', 'relationship', 'character', 'freeform']
+    #     categories = ['language', 'published', 'status', 'date status', 'words', 'chapters', 'comments', 'kudos', 'bookmarks', 'hits'] 
+    sql = "UPDATE works SET rating = %s, category = %s, fandom = %s, relationship = %s, `character` = %s, freeform = %s, " \
+          "status = %s, status_date = %s, words = %s, chapters = %s, comments = %s, kudos = %s, bookmarks = %s, hits = %s WHERE id = %s"
+    val = (", ".join(tags[0]), ", ".join(tags[1]), ", ".join(tags[2]), ", ".join(tags[3]), ", ".join(tags[4]), ", ".join(tags[5]), \
+           stats[2], stats[3], int(stats[4].replace(',', '')), stats[5], int(stats[6].replace(',', '')), int(stats[7].replace(',', '')), int(stats[8].replace(',', '')), int(stats[9].replace(',', '')), fic_id)
+    cursor.execute(sql, val)
+    # tags are often added to works in progress, so relink them all
+    cursor.execute("DELETE FROM work_tags WHERE work_id = %s", (fic_id, ))
+    write_tags(cursor, fic_id, tags)
+    db.commit()
+    print('Done.')
+    sleep(delay)
+
+def insert_chap(cursor, sql, val):
+    if stage_dir:
+        stage_row(stage_dir, 'chaps', val)
+    else:
+        cursor.execute(sql, val)
+
+def write_fic_to_db(fic_id, errorwriter, refresh_wips=False):    
     # connect to database
     db = mysql.connector.connect(
         host = "localhost",
@@ -121,11 +309,17 @@ def write_fic_to_db(fic_id, errorwriter):
     )
     cursor = db.cursor()
     
-    # check if work already in db, if so, pass
+    # check if work already staged or in db, if so, pass
+    if str(fic_id) in staged_ids:
+        print("Duplicate work (already staged):", fic_id)
+        return
     sql = "SELECT COUNT(*) FROM fics.works WHERE id = %s"
     val = (fic_id, )
     cursor.execute(sql, val)
     if cursor.fetchone()[0] > 0:
+        if refresh_wips and is_wip(cursor, fic_id):
+            refresh_wip(db, cursor, fic_id, errorwriter)
+            return
         print("Duplicate work:", fic_id)
         return
     
@@ -179,7 +373,12 @@ def write_fic_to_db(fic_id, errorwriter):
     sql = "INSERT INTO works VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
     val = (fic_id, title, ", ".join(author), ", ".join(tags[0]), ", ".join(tags[1]), ", ".join(tags[2]), ", ".join(tags[3]), ", ".join(tags[4]), ", ".join(tags[5]), \
            stats[0], stats[1], stats[2], stats[3], int(stats[4].replace(',', '')), stats[5], int(stats[6].replace(',', '')), int(stats[7].replace(',', '')), int(stats[8].replace(',', '')), int(stats[9].replace(',', '')))
-    cursor.execute(sql, val)
+    # when staging, the works row goes last (below), so a work only counts
+    # as staged once all its chapters are
+    work_val = val
+    if not stage_dir:
+        cursor.execute(sql, val)
+        write_tags(cursor, fic_id, tags)
  
  
     # write fic chaps to table
@@ -209,7 +408,7 @@ def write_fic_to_db(fic_id, errorwriter):
             text = "" 
         
         val = (fic_id, 1, title, summary, notes, endnotes, text)
-        cursor.execute(sql, val)
+        insert_chap(cursor, sql, val)
     
     # multi-chapter case
     else:
@@ -228,23 +427,21 @@ def write_fic_to_db(fic_id, errorwriter):
                 endnotes = soup.select_one(".end.notes.module")
                 if endnotes: endnotes = endnotes.text
             else:
-                summary = chapter.select_one("div[id=summary]")
-                if summary: summary = summary.text
-                
-                notes = chapter.select_one("div[id=notes]")
-                if notes: notes = notes.text
-                
-                endnotes = chapter.select_one(".end.notes.module")
-                if endnotes: endnotes = endnotes.text
+                summary, notes, endnotes = get_chapter_notes(chapter)
         
-            body = chapter.select_one(".userstuff.module")
-            lines = body.select("p")
-            text = "\n".join([unidecode(line.text) for line in lines])
+            text = get_chapter_text(chapter)
             
             val = (fic_id, i + 1, title, summary, notes, endnotes, text)
-            cursor.execute(sql, val)
+            insert_chap(cursor, sql, val)
             
  
+    if stage_dir:
+        for tag_type, names in zip(tag_types, tags):
+            for name in names:
+                stage_row(stage_dir, 'work_tags', (fic_id, tag_type, name))
+        stage_row(stage_dir, 'works', work_val)
+        staged_ids.add(str(fic_id))
+
     # write comments to table
     # will have to scrape by chapter instead of by entire work...
     # actually each comment specifies which chapter it was on....
@@ -255,19 +452,92 @@ def write_fic_to_db(fic_id, errorwriter):
     sleep(delay)
 
 
+def set_stage_dir(path):
+    global stage_dir
+    stage_dir = path
+    if stage_dir:
+        os.makedirs(stage_dir, exist_ok=True)
+        # works staged by an earlier run that haven't been loaded yet
+        works_name = os.path.join(stage_dir, 'works.tsv')
+        if os.path.exists(works_name):
+            with open(works_name, "r", encoding="utf-8", newline="") as f_in:
+                for line in f_in:
+                    staged_ids.add(line.split("\t", 1)[0])
+
 def get_args(): 
     parser = argparse.ArgumentParser(description='Scrape and save some fanfic, given their AO3 IDs.')
     parser.add_argument(
-        'ids', metavar='IDS', nargs='+',
-        help='a single id, a space seperated list of ids, or a csv input filename')
+        'ids', metavar='IDS', nargs='*',
+        help='a single id, a space seperated list of ids, or a csv input filename (optional with --refresh-wips)')
     parser.add_argument(
         '--restart', default='', 
         help='work_id to start at from within a csv')
+    parser.add_argument(
+        '--refresh-wips', action='store_true',
+        help='for works already scraped that are still in progress, fetch only their new chapters and update their stats')
+    parser.add_argument(
+        '--priority', default='csv', choices=['csv', 'kudos', 'updated', 'small'],
+        help='order to scrape a csv in: csv order, most kudos first, most recently updated first, or fewest words first')
+    parser.add_argument(
+        '--large_words', default=0,
+        help='works with more words than this go in a separate lane so they don\'t hold up the rest (default off)')
+    parser.add_argument(
+        '--large_every', default=10,
+        help='with --large_words, scrape one large work after every this many others')
+    parser.add_argument(
+        '--stage', default='',
+        help='folder to write rows to for ao3_bulk_load.py, instead of inserting them one at a time')
     args = parser.parse_args()
     fic_ids = args.ids
+    if not fic_ids and not args.refresh_wips:
+        parser.error('IDS is required unless --refresh-wips is given')
     is_csv = (len(fic_ids) == 1 and '.csv' in fic_ids[0]) 
     restart = str(args.restart)
-    return fic_ids, restart, is_csv
+    if args.stage and args.refresh_wips:
+        # refreshing updates rows in place, which can't be staged
+        parser.error('--stage and --refresh-wips can\'t be used together')
+    if int(args.large_every) < 1:
+        parser.error('--large_every must be at least 1')
+    set_stage_dir(args.stage)
+    schedule = (args.priority, int(args.large_words), int(args.large_every))
+    return fic_ids, restart, is_csv, args.refresh_wips, schedule
+
+def get_row_stat(row, i):
+    '''
+    returns column i of an id csv row as an int, or None if missing
+    (columns after id and url are words, chapters, kudos, updated, as written by ao3_work_ids.py)
+    '''
+    try:
+        return int(row[i])
+    except (IndexError, ValueError):
+        return None
+
+def schedule_rows(rows, priority, large_words, large_every):
+    '''
+    orders the csv rows to scrape by priority. rows without the stat being
+    sorted on keep their csv order after the rest.
+    if large_words is set, works longer than that are pulled into their own
+    lane and one is scraped after every large_every of the others
+    '''
+    if priority == 'kudos':
+        rows = sorted(rows, key=lambda row: (get_row_stat(row, 4) is None, -(get_row_stat(row, 4) or 0)))
+    elif priority == 'updated':
+        # dates are YYYY-MM-DD so they sort as strings
+        rows = sorted(rows, key=lambda row: row[5] if len(row) > 5 else '', reverse=True)
+    elif priority == 'small':
+        rows = sorted(rows, key=lambda row: (get_row_stat(row, 2) is None, get_row_stat(row, 2) or 0))
+
+    if not large_words:
+        return rows
+
+    small = [row for row in rows if (get_row_stat(row, 2) or 0) <= large_words]
+    large = [row for row in rows if (get_row_stat(row, 2) or 0) > large_words]
+    scheduled = []
+    for i, row in enumerate(small):
+        scheduled.append(row)
+        if large and (i + 1) % large_every == 0:
+            scheduled.append(large.pop(0))
+    return scheduled + large
 
 def process_id(fic_id, restart, found):
     if found:
@@ -277,24 +547,49 @@ def process_id(fic_id, restart, found):
     else:
         return False
 
+def get_wip_ids():
+    '''
+    returns the ids of the works in the db whose status is "Updated"
+    '''
+    db = mysql.connector.connect(
+        host = "localhost",
+        user = "root",
+        password = "password",
+        database = "fics"
+    )
+    cursor = db.cursor()
+    cursor.execute("SELECT id FROM works WHERE status = 'Updated' ORDER BY id")
+    return [str(row[0]) for row in cursor.fetchall()]
+
 def main():
-    fic_ids, restart, is_csv = get_args()
+    fic_ids, restart, is_csv, refresh_wips, schedule = get_args()
     start = False
     if restart == '': start = True
     
-    with open(fic_ids[0], "r+", newline="") as f_in:
-        reader = csv.reader(f_in)
-        with open(fic_ids[0][:fic_ids[0].find(".")] + "_errors.csv", "a", newline="") as e_out:
-            errorwriter = csv.writer(e_out)
+    if is_csv:
+        with open(fic_ids[0], "r+", newline="") as f_in:
+            rows = [row for row in csv.reader(f_in) if row]
+        error_name = fic_ids[0][:fic_ids[0].find(".")] + "_errors.csv"
+    elif fic_ids:
+        rows = [[fic_id] for fic_id in fic_ids]
+        error_name = "errors.csv"
+    else:
+        # --refresh-wips on its own re-checks every work in progress
+        rows = [[fic_id] for fic_id in get_wip_ids()]
+        error_name = "refresh_errors.csv"
+    rows = schedule_rows(rows, *schedule)
+
+    with open(error_name, "a", newline="") as e_out:
+        errorwriter = csv.writer(e_out)
+        
+        for i, row in enumerate(rows):
+            # ignore until we reach row to restart scrape from
+            if not start:
+                if row[0] != restart: continue
+                start = True
             
-            for row in reader:
-                if not row: continue
-                
-                # ignore until we reach row to restart scrape from
-                if not start:
-                    if row[0] != restart: continue
-                    start = True
-                
-                write_fic_to_db(row[0], errorwriter)
+            print("[" + str(i + 1) + "/" + str(len(rows)) + "]")
+            write_fic_to_db(row[0], errorwriter, refresh_wips)
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+######
+#
+# This script takes in (a list or csv of) fic IDs and
+# saves the users who left kudos on or bookmarked each fic.
+#
+# Usage - python ao3_get_interactions.py ID
+#
+# ID is a required argument. It is either a single number,
+# multiple numbers seperated by spaces, or a csv filename where
+# the IDs are the first column.
+# The scrape is planned from each work's current kudos and bookmark counts.
+# A csv from ao3_work_ids.py has them in its kudos and bookmarks columns.
+# Otherwise the work's page is read first for them (and they're saved to
+# the works table); --stored-counts skips that request and trusts the counts
+# already in works, e.g. right after ao3_get_fanfics.py or --refresh-wips.
+# A work whose count equals the one at its last harvest is skipped, so kudos
+# removed since then and as many new ones look unchanged until the count moves.
+#
+# --restart is an optional string which when used in combination with a csv input will start
+# the scraping from the given work_id, skipping all previous rows in the csv
+# --kudos-only / --bookmarks-only restrict the scrape to one kind of interaction
+#
+# Tables:
+#   kudos (work_id, user), unique on (work_id, user)
+#   bookmarks (work_id, user), unique on (work_id, user)
+#   interaction_counts (work_id, kind, count), unique on (work_id, kind)
+#     the kudos or bookmark count a work had when it was last harvested,
+#     so unchanged works can be skipped without a request
+#######
+import requests
+from bs4 import BeautifulSoup
+import argparse
+import csv
+import math
+import re
+import mysql.connector
+from time import sleep
+
+# seconds to wait between page requests
+delay = 5
+
+# kind of interaction -> (works table column, interaction table)
+kinds = {
+    'kudos': ('kudos', 'kudos'),
+    'bookmarks': ('bookmarks', 'bookmarks'),
+}
+
+def get_page(url, fic_id, errorwriter):
+    '''
+    returns the soup for a url, or None if AO3 answered with an error
+    '''
+    # if rate-limited, wait a minute
+    status = 429
+    while 429 == status:
+        req = requests.get(url)
+        status = req.status_code
+        if 429 == status:
+            print("Request answered with Status-Code 429")
+            print("Trying again in 1 minute...")
+            sleep(60)
+    # for other errors, write out to csv and pass
+    if 400 <= status:
+        print("Error scraping ", fic_id, "Status ", str(status))
+        errorwriter.writerow([fic_id, status, url])
+        return None
+    return BeautifulSoup(req.text, 'html.parser')
+
+def get_num_pages(soup):
+    '''
+    returns the number of pages in a paginated listing, 1 if it isn't paginated
+    '''
+    pagination = soup.find('ol', class_='pagination actions')
+    if not pagination:
+        return 1
+    # last item is "Next", the one before it is the last page number
+    return int(pagination.findChildren("li", recursive=False)[-2].text)
+
+def get_kudos_users(soup):
+    '''
+    returns the usernames on a kudos page (guests aren't named)
+    '''
+    kudos = soup.find(id="kudos")
+    if not kudos:
+        return []
+    users = []
+    for link in kudos.find_all('a', href=True):
+        if link['href'].startswith('/users/'):
+            users.append(link.text.strip())
+    return users
+
+def get_bookmark_users(soup):
+    '''
+    returns the usernames on a bookmarks page (private bookmarks aren't listed)
+    '''
+    users = []
+    for bookmark in soup.select("li.user.short.blurb.group"):
+        byline = bookmark.find("h5", class_="byline heading")
+        if byline and byline.find('a'):
+            users.append(byline.find('a').text.strip())
+    return users
+
+def get_guests(soup):
+    '''
+    returns the number of guest kudos on a kudos page; they count towards
+    the work's kudos but aren't listed
+    '''
+    kudos = soup.find(id="kudos")
+    if not kudos:
+        return 0
+    match = re.search(r"([\d,]+)\s+guests?", kudos.text)
+    return int(match.group(1).replace(",", "")) if match else 0
+
+def get_csv_counts(row, todo):
+    '''
+    returns {kind: count} from the kudos (5th) and bookmarks (7th) columns of
+    an ao3_work_ids.py csv row, or None if a kind in todo isn't there
+    '''
+    columns = {'kudos': 4, 'bookmarks': 6}
+    counts = {}
+    for kind in todo:
+        i = columns[kind]
+        if len(row) <= i or not row[i].isdigit():
+            return None
+        counts[kind] = int(row[i])
+    return counts
+
+def get_stored_counts(cursor, fic_id):
+    '''
+    returns {kind: count} as stored in works, or None if the work isn't there
+    '''
+    columns = ", ".join(kinds[kind][0] for kind in kinds)
+    cursor.execute("SELECT " + columns + " FROM fics.works WHERE id = %s", (fic_id, ))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return dict(zip(kinds, row))
+
+def refresh_counts(db, cursor, fic_id, errorwriter):
+    '''
+    reads the current kudos and bookmark counts from the work page and saves
+    them to works, so the skip below doesn't trust counts from an old scrape.
+    returns {kind: count}, or None if the page couldn't be read
+    '''
+    soup = get_page('http://archiveofourown.org/works/' + str(fic_id) + '?view_adult=true', fic_id, errorwriter)
+    if soup is None or not soup.find("dl", class_="stats"):
+        return None
+    counts = {}
+    for kind in kinds:
+        stat = soup.find("dl", class_="stats").find("dd", class_=kinds[kind][0])
+        counts[kind] = int(stat.text.replace(',', '')) if stat else 0
+    sql = "UPDATE works SET " + ", ".join(kinds[kind][0] + " = %s" for kind in kinds) + " WHERE id = %s"
+    cursor.execute(sql, [counts[kind] for kind in kinds] + [fic_id])
+    db.commit()
+    return counts
+
+def get_harvested(cursor, fic_id, kind):
+    '''
+    returns (count at the last harvest, users stored so far)
+    '''
+    _, table = kinds[kind]
+    cursor.execute("SELECT count FROM fics.interaction_counts WHERE work_id = %s AND kind = %s", (fic_id, kind))
+    row = cursor.fetchone()
+    harvested = row[0] if row else 0
+
+    cursor.execute("SELECT COUNT(*) FROM " + table + " WHERE work_id = %s", (fic_id, ))
+    stored = cursor.fetchone()[0]
+    return harvested, stored
+
+def write_users(db, cursor, fic_id, kind, users):
+    _, table = kinds[kind]
+    sql = "INSERT IGNORE INTO " + table + " (work_id, user) VALUES (%s, %s)"
+    cursor.executemany(sql, [(fic_id, user) for user in users])
+    db.commit()
+
+def harvest(db, cursor, fic_id, kind, current, errorwriter):
+    '''
+    walks the kudos or bookmarks listing of a work, newest first,
+    stopping once the new interactions since the last harvest are covered.
+    current is the work's kudos or bookmark count (None if unknown).
+    returns the number of requests made
+    '''
+    harvested, stored = get_harvested(cursor, fic_id, kind)
+    if current is not None and current == harvested:
+        print("Unchanged", kind, "for", fic_id)
+        return 0
+
+    if kind == 'kudos':
+        base = 'http://archiveofourown.org/works/' + str(fic_id) + '/kudos'
+        get_users = get_kudos_users
+    else:
+        base = 'http://archiveofourown.org/works/' + str(fic_id) + '/bookmarks'
+        get_users = get_bookmark_users
+
+    soup = get_page(base, fic_id, errorwriter)
+    if soup is None:
+        return 1
+    requests_made = 1
+
+    users = get_users(soup)
+    num_pages = get_num_pages(soup)
+    # AO3 lists the newest first, so only the first pages can hold new users.
+    # guest kudos are in the count but not in the listing, so leave them out.
+    # without a count we have to walk everything
+    if current is None or not users:
+        pages_needed = num_pages
+    else:
+        guests = get_guests(soup) if kind == 'kudos' else 0
+        new_users = current - guests - stored
+        pages_needed = max(1, min(num_pages, math.ceil(new_users / len(users))))
+
+    print("Scraping", kind, "for", fic_id, "-", pages_needed, "of", num_pages, "pages")
+    write_users(db, cursor, fic_id, kind, users)
+
+    for page in range(2, pages_needed + 1):
+        sleep(delay)
+        soup = get_page(base + '?page=' + str(page), fic_id, errorwriter)
+        requests_made = requests_made + 1
+        if soup is None:
+            # leave interaction_counts alone so the next run tries again
+            return requests_made
+        write_users(db, cursor, fic_id, kind, get_users(soup))
+
+    if current is not None:
+        sql = "INSERT INTO interaction_counts (work_id, kind, count) VALUES (%s, %s, %s) " \
+              "ON DUPLICATE KEY UPDATE count = VALUES(count)"
+        cursor.execute(sql, (fic_id, kind, current))
+        db.commit()
+    return requests_made
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Scrape the users who left kudos on or bookmarked some fanfic, given their AO3 IDs.')
+    parser.add_argument(
+        'ids', metavar='IDS', nargs='+',
+        help='a single id, a space seperated list of ids, or a csv input filename')
+    parser.add_argument(
+        '--restart', default='',
+        help='work_id to start at from within a csv')
+    parser.add_argument(
+        '--kudos-only', action='store_true',
+        help='only scrape kudos')
+    parser.add_argument(
+        '--bookmarks-only', action='store_true',
+        help='only scrape bookmarks')
+    parser.add_argument(
+        '--stored-counts', action='store_true',
+        help='trust the kudos and bookmark counts in works instead of reading them from the work page first')
+    args = parser.parse_args()
+    fic_ids = args.ids
+    is_csv = (len(fic_ids) == 1 and '.csv' in fic_ids[0])
+    restart = str(args.restart)
+    todo = []
+    if not args.bookmarks_only: todo.append('kudos')
+    if not args.kudos_only: todo.append('bookmarks')
+    return fic_ids, restart, is_csv, todo, args.stored_counts
+
+def main():
+    fic_ids, restart, is_csv, todo, stored_counts = get_args()
+    start = False
+    if restart == '': start = True
+
+    # connect to database
+    db = mysql.connector.connect(
+        host = "localhost",
+        user = "root",
+        password = "password",
+        database = "fics"
+    )
+    cursor = db.cursor()
+
+    if is_csv:
+        with open(fic_ids[0], "r", newline="") as f_in:
+            rows = [row for row in csv.reader(f_in) if row]
+        error_name = fic_ids[0][:fic_ids[0].find(".")] + "_interaction_errors.csv"
+    else:
+        rows = [[fic_id] for fic_id in fic_ids]
+        error_name = "interaction_errors.csv"
+
+    with open(error_name, "a", newline="") as e_out:
+        errorwriter = csv.writer(e_out)
+        total_requests = 0
+        for row in rows:
+            fic_id = row[0]
+            # ignore until we reach row to restart scrape from
+            if not start:
+                if fic_id != restart: continue
+                start = True
+
+            # counts from the csv cost nothing, fall back to works or the work page
+            counts = get_csv_counts(row, todo)
+            if counts is None and stored_counts:
+                counts = get_stored_counts(cursor, fic_id)
+            elif counts is None:
+                counts = refresh_counts(db, cursor, fic_id, errorwriter)
+                total_requests = total_requests + 1
+                sleep(delay)
+
+            for kind in todo:
+                current = counts[kind] if counts else None
+                made = harvest(db, cursor, fic_id, kind, current, errorwriter)
+                total_requests = total_requests + made
+                # wait a little to avoid rate limiting
+                if made: sleep(delay)
+
+    print("Done.", total_requests, "requests made.")
+
+main()
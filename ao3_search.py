@@ -0,0 +1,284 @@
+######
+#
+# This script keeps a full-text index of the chapters and comments in the
+# fics database, and searches it.
+#
+# Usage - python ao3_search.py QUERY
+#         python ao3_search.py --update
+#
+# QUERY is an SQLite FTS5 query: words, "quoted phrases", AND / OR / NOT, prefix*.
+# Results show the work, chapter and a snippet around the match, with the
+# work's title, author and fandom from the works table.
+#
+# --update indexes chapters and comments added since the last update
+#   (run it after ao3_get_fanfics.py / ao3_get_comments.py, including --refresh-wips)
+# --rebuild throws the index away and streams the whole database into a new one
+# --comments searches comments instead of chapters
+# --index sets the index file (default fics_search.db)
+#
+# The index is an SQLite file with two FTS5 tables, chapter_text and comment_text,
+# and an indexed table recording how many chapters and comments of each work it holds.
+# The FTS5 columns besides text can't be looked up by, so indexed_chapters and
+# indexed_comments map each work to the rowids of its rows (a comment's rowid is
+# its comment id), for finding what's already indexed and forgetting a work.
+# Index files made before these two tables existed need --rebuild.
+#######
+import argparse
+import os
+import re
+import sqlite3
+import mysql.connector
+
+# rows read from the server and written to the index at a time
+chunk_size = 1000
+
+# kind of row -> (FTS table, table of its rowids by work)
+kinds = {
+    'chapters': ('chapter_text', 'indexed_chapters'),
+    'comments': ('comment_text', 'indexed_comments'),
+}
+
+def connect():
+    return mysql.connector.connect(
+        host = "localhost",
+        user = "root",
+        password = "password",
+        database = "fics"
+    )
+
+def open_index(path):
+    index = sqlite3.connect(path)
+    tables = set(row[0] for row in index.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    if 'indexed' in tables and 'indexed_chapters' not in tables:
+        raise SystemExit("The index " + path + " was made by an older version of this script, run with --rebuild")
+    index.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chapter_text USING fts5("
+                  "text, fic_id UNINDEXED, chapter UNINDEXED, tokenize='porter unicode61')")
+    index.execute("CREATE VIRTUAL TABLE IF NOT EXISTS comment_text USING fts5("
+                  "text, fic_id UNINDEXED, chapter UNINDEXED, tokenize='porter unicode61')")
+    index.execute("CREATE TABLE IF NOT EXISTS indexed ("
+                  "fic_id INTEGER PRIMARY KEY, chapters INTEGER DEFAULT 0, comments INTEGER DEFAULT 0)")
+    index.execute("CREATE TABLE IF NOT EXISTS indexed_chapters (id INTEGER PRIMARY KEY, fic_id INTEGER)")
+    index.execute("CREATE INDEX IF NOT EXISTS indexed_chapters_fic_id ON indexed_chapters (fic_id)")
+    index.execute("CREATE TABLE IF NOT EXISTS indexed_comments (id INTEGER PRIMARY KEY, fic_id INTEGER)")
+    index.execute("CREATE INDEX IF NOT EXISTS indexed_comments_fic_id ON indexed_comments (fic_id)")
+    return index
+
+def add_counts(index, counts, column):
+    '''
+    adds {fic id: rows} to the chapters or comments column of indexed
+    '''
+    index.executemany("INSERT OR IGNORE INTO indexed (fic_id) VALUES (?)", [(fic_id, ) for fic_id in counts])
+    index.executemany("UPDATE indexed SET " + column + " = " + column + " + ? WHERE fic_id = ?",
+                      [(n, fic_id) for fic_id, n in counts.items()])
+
+def index_chapters(index, rows):
+    '''
+    indexes chaps rows (fic id, chapter number, title, summary, notes, end notes, text)
+    '''
+    for row in rows:
+        # the FTS row takes the id indexed_chapters gives it
+        rowid = index.execute("INSERT INTO indexed_chapters (fic_id) VALUES (?)", (row[0], )).lastrowid
+        index.execute("INSERT INTO chapter_text (rowid, text, fic_id, chapter) VALUES (?, ?, ?, ?)",
+                      (rowid, row[6] or "", row[0], row[1]))
+    counts = {}
+    for row in rows:
+        counts[row[0]] = counts.get(row[0], 0) + 1
+    add_counts(index, counts, "chapters")
+
+def index_comments(index, rows):
+    '''
+    indexes comments rows (fic id, comment id, chapter, user, date, parent id, text)
+    '''
+    index.executemany("INSERT INTO indexed_comments (id, fic_id) VALUES (?, ?)",
+                      [(int(row[1]), row[0]) for row in rows])
+    index.executemany("INSERT INTO comment_text (rowid, text, fic_id, chapter) VALUES (?, ?, ?, ?)",
+                      [(int(row[1]), row[6] or "", row[0], row[2]) for row in rows])
+    counts = {}
+    for row in rows:
+        counts[row[0]] = counts.get(row[0], 0) + 1
+    add_counts(index, counts, "comments")
+
+def stream(cursor, sql, vals=()):
+    '''
+    yields lists of up to chunk_size rows. the default cursor is unbuffered,
+    so the rows stay on the server until fetched
+    '''
+    cursor.execute(sql, vals)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+def rebuild(index_path):
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    index = open_index(index_path)
+    db = connect()
+    cursor = db.cursor()
+
+    done = 0
+    for rows in stream(cursor, "SELECT * FROM chaps"):
+        index_chapters(index, rows)
+        index.commit()
+        done = done + len(rows)
+        print("Indexed", done, "chapters")
+
+    done = 0
+    for rows in stream(cursor, "SELECT * FROM comments"):
+        index_comments(index, rows)
+        index.commit()
+        done = done + len(rows)
+        print("Indexed", done, "comments")
+
+    index.execute("INSERT INTO chapter_text (chapter_text) VALUES ('optimize')")
+    index.execute("INSERT INTO comment_text (comment_text) VALUES ('optimize')")
+    index.commit()
+
+def get_changed(cursor, index, table, column):
+    '''
+    returns {fic id: (rows already indexed, rows in table)} for works whose
+    row count in table differs from what the index holds
+    '''
+    indexed = dict(index.execute("SELECT fic_id, " + column + " FROM indexed"))
+    changed = {}
+    for rows in stream(cursor, "SELECT fic_id, COUNT(*) FROM " + table + " GROUP BY fic_id"):
+        for fic_id, n in rows:
+            if indexed.get(fic_id, 0) != n:
+                changed[fic_id] = (indexed.get(fic_id, 0), n)
+    return changed
+
+def forget(index, kind, fic_id):
+    '''
+    removes a work's chapters or comments from the index so they can be indexed again
+    '''
+    table, ids = kinds[kind]
+    # look the rowids up by work, rather than scanning the FTS table
+    index.execute("DELETE FROM " + table + " WHERE rowid IN (SELECT id FROM " + ids + " WHERE fic_id = ?)", (fic_id, ))
+    index.execute("DELETE FROM " + ids + " WHERE fic_id = ?", (fic_id, ))
+    index.execute("UPDATE indexed SET " + kind + " = 0 WHERE fic_id = ?", (fic_id, ))
+
+def set_count(index, column, fic_id, n):
+    index.execute("UPDATE indexed SET " + column + " = ? WHERE fic_id = ?", (n, fic_id))
+
+def update(index_path):
+    '''
+    indexes only the chapters and comments that aren't in the index yet
+    '''
+    index = open_index(index_path)
+    db = connect()
+    cursor = db.cursor()
+
+    # chapters are normally only appended, so skip the ones already indexed.
+    # if the database has fewer than the index, index the work again
+    changed = get_changed(cursor, index, "chaps", "chapters")
+    for fic_id, (have, n) in changed.items():
+        if have > n:
+            forget(index, "chapters", fic_id)
+            have = 0
+        rows = []
+        for chunk in stream(cursor, "SELECT * FROM chaps WHERE fic_id = %s ORDER BY 2", (fic_id, )):
+            rows += chunk
+        index_chapters(index, rows[have:])
+        set_count(index, "chapters", fic_id, n)
+        index.commit()
+    print("Indexed new chapters of", len(changed), "works")
+
+    # comments can arrive in any order, so compare ids
+    changed = get_changed(cursor, index, "comments", "comments")
+    for fic_id, (indexed_count, n) in changed.items():
+        if indexed_count > n:
+            forget(index, "comments", fic_id)
+        have = set(row[0] for row in index.execute("SELECT id FROM indexed_comments WHERE fic_id = ?", (fic_id, )))
+        rows = []
+        for chunk in stream(cursor, "SELECT * FROM comments WHERE fic_id = %s", (fic_id, )):
+            rows += [row for row in chunk if int(row[1]) not in have]
+        index_comments(index, rows)
+        # record what the database holds, so this work isn't looked at again until it changes
+        set_count(index, "comments", fic_id, n)
+        index.commit()
+    print("Indexed new comments of", len(changed), "works")
+
+def quote_terms(query):
+    '''
+    puts quotes around bare words with a hyphen or apostrophe, which FTS5
+    would otherwise read as syntax (don't, consulting-detective)
+    '''
+    def quote(match):
+        term = match.group(0)
+        lead, word, trail = re.match(r"^(\(*)(.*?)(\**\)*)$", term).groups()
+        if "-" in word or "'" in word:
+            word = '"' + word + '"'
+        return lead + word + trail
+    # leave "quoted phrases" as they are
+    return re.sub(r'"[^"]*"|[^\s"]+', lambda m: m.group(0) if m.group(0).startswith('"') else quote(m), query)
+
+def search(index_path, query, comments, limit):
+    '''
+    returns (fic id, chapter, snippet) for the best matches of an FTS5 query
+    '''
+    index = open_index(index_path)
+    table = "comment_text" if comments else "chapter_text"
+    sql = "SELECT fic_id, chapter, snippet(" + table + ", 0, '[', ']', '...', 12) FROM " + table + \
+          " WHERE " + table + " MATCH ? ORDER BY rank LIMIT ?"
+    return index.execute(sql, (quote_terms(query), limit)).fetchall()
+
+def get_work_info(fic_ids):
+    '''
+    returns {fic id: (title, author, fandom)} from the works table
+    '''
+    if not fic_ids:
+        return {}
+    db = connect()
+    cursor = db.cursor()
+    sql = "SELECT id, title, author, fandom FROM works WHERE id IN (" + ", ".join(["%s"] * len(fic_ids)) + ")"
+    cursor.execute(sql, list(fic_ids))
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Full-text search over the chapters and comments in the fics database.')
+    parser.add_argument(
+        'query', metavar='QUERY', nargs='?', default='',
+        help='words or "quoted phrases" to search for (SQLite FTS5 syntax)')
+    parser.add_argument(
+        '--update', action='store_true',
+        help='index chapters and comments added since the last update')
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help='rebuild the whole index from the database')
+    parser.add_argument(
+        '--comments', action='store_true',
+        help='search comments instead of chapters')
+    parser.add_argument(
+        '--limit', default=20,
+        help='number of results to show')
+    parser.add_argument(
+        '--index', default='fics_search.db',
+        help='index file')
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.rebuild:
+        rebuild(args.index)
+    elif args.update:
+        update(args.index)
+
+    if not args.query:
+        return
+
+    try:
+        results = search(args.index, args.query, args.comments, int(args.limit))
+    except sqlite3.OperationalError as e:
+        print("Bad query:", args.query)
+        print("   ", e)
+        print("Use words, \"quoted phrases\", AND / OR / NOT and prefix*, e.g. '\"consulting detective\" violin'")
+        return
+    info = get_work_info(set(row[0] for row in results))
+    for fic_id, chapter, snippet in results:
+        title, author, fandom = info.get(fic_id, ('', '', ''))
+        print(str(fic_id) + ", chapter " + str(chapter) + ": " + title + " by " + author + " (" + fandom + ")")
+        print("   ", snippet.replace("\n", " "))
+
+if __name__ == '__main__':
+    main()
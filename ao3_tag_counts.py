@@ -0,0 +1,208 @@
+######
+#
+# This script counts the works in the fics database that use a tag
+# or any of its wrangled synonyms, and which tags are used alongside it.
+#
+# Usage - python ao3_tag_counts.py TAG [TAG ...]
+#
+# TAG is a tag name as written on AO3, e.g. "Fluff".
+#
+# --cooccur N also lists the N tags most often used on the same works
+# --no-synonyms counts only the exact tag
+# --refresh refetches the synonyms from AO3 instead of using the local cache
+# --backfill fills tags/work_tags from the tag columns of works scraped
+#   before ao3_get_fanfics.py wrote them (tags containing ", " get split there)
+#
+# Tables (ao3_get_fanfics.py writes the first two for every work):
+#   CREATE TABLE tags (id INT AUTO_INCREMENT PRIMARY KEY, type VARCHAR(16), name VARCHAR(255),
+#                      UNIQUE KEY (type, name), KEY (name))
+#   CREATE TABLE work_tags (work_id INT, tag_id INT, PRIMARY KEY (work_id, tag_id), KEY (tag_id, work_id))
+#   CREATE TABLE tag_synonyms (tag VARCHAR(255), synonym VARCHAR(255), PRIMARY KEY (tag, synonym))
+#######
+import requests
+from bs4 import BeautifulSoup
+import argparse
+from urllib.parse import quote
+from unidecode import unidecode
+import mysql.connector
+from time import sleep
+from ao3_get_fanfics import tag_types, write_tags
+
+# rows read at a time when backfilling
+chunk_size = 1000
+
+def connect():
+    return mysql.connector.connect(
+        host = "localhost",
+        user = "root",
+        password = "password",
+        database = "fics"
+    )
+
+def fetch_tag_page(tag):
+    url = 'http://archiveofourown.org/tags/' + quote(tag, safe='')
+    print("Fetching synonyms:", url)
+    # if rate-limited, wait a minute
+    status = 429
+    while 429 == status:
+        req = requests.get(url)
+        status = req.status_code
+        if 429 == status:
+            print("Request answered with Status-Code 429")
+            print("Trying again in 1 minute...")
+            sleep(60)
+    if 400 <= status:
+        print("Error fetching tag", tag, "Status", str(status))
+        return None
+    return BeautifulSoup(req.text, 'html.parser')
+
+def scrape_synonyms(tag):
+    '''
+    returns the tag's canonical tag and its wrangled synonyms, as listed on AO3,
+    or None if AO3 couldn't be reached. names are passed through unidecode,
+    like the tags ao3_get_fanfics.py saves, but pages are fetched by their AO3 name
+    '''
+    soup = fetch_tag_page(tag)
+    if soup is None:
+        return None
+
+    # a synonym's page points to its canonical tag, whose page lists the rest
+    merger = soup.find("div", class_="merger")
+    if merger and merger.find("a", class_="tag"):
+        tag = merger.find("a", class_="tag").text.strip()
+        # 5 second delay between requests as per AO3's terms of service
+        sleep(5)
+        soup = fetch_tag_page(tag)
+        if soup is None:
+            return None
+
+    names = [unidecode(tag)]
+    synonyms = soup.find("div", class_="synonym")
+    if synonyms:
+        names += [unidecode(link.text.strip()) for link in synonyms.find_all("a", class_="tag")]
+    return names
+
+def get_synonyms(db, cursor, tag, refresh):
+    '''
+    returns the tag and its synonyms, from the local cache or AO3
+    '''
+    name = tag
+    # the cache and the tags table hold names passed through unidecode
+    tag = unidecode(tag)
+    cursor.execute("SELECT synonym FROM tag_synonyms WHERE tag = %s", (tag, ))
+    cached = [row[0] for row in cursor.fetchall()]
+    if cached and not refresh:
+        return cached
+
+    names = scrape_synonyms(name)
+    if names is None:
+        # keep the cache as it is, and make do for this run
+        if cached:
+            print("Using cached synonyms for", tag)
+            return cached
+        print("Counting only the exact tag", tag)
+        return [tag]
+    # cache under the name asked for; the tag itself is always a row, so a
+    # tag without synonyms is still cached
+    names = [tag] + [name for name in names if name != tag]
+    cursor.execute("DELETE FROM tag_synonyms WHERE tag = %s", (tag, ))
+    cursor.executemany("INSERT IGNORE INTO tag_synonyms (tag, synonym) VALUES (%s, %s)",
+                       [(tag, name) for name in names])
+    db.commit()
+    return names
+
+def get_tag_ids(cursor, names):
+    sql = "SELECT id FROM tags WHERE name IN (" + ", ".join(["%s"] * len(names)) + ")"
+    cursor.execute(sql, names)
+    return [row[0] for row in cursor.fetchall()]
+
+def count_works(cursor, tag_ids):
+    '''
+    number of works with any of the tags, answered from the work_tags (tag_id, work_id) index
+    '''
+    if not tag_ids:
+        return 0
+    sql = "SELECT COUNT(DISTINCT work_id) FROM work_tags WHERE tag_id IN (" + ", ".join(["%s"] * len(tag_ids)) + ")"
+    cursor.execute(sql, tag_ids)
+    return cursor.fetchone()[0]
+
+def cooccurring_tags(cursor, tag_ids, limit):
+    '''
+    returns (type, name, works) for the tags most often on the same works as any of tag_ids
+    '''
+    if not tag_ids:
+        return []
+    placeholders = ", ".join(["%s"] * len(tag_ids))
+    sql = "SELECT t.type, t.name, COUNT(DISTINCT a.work_id) AS works FROM work_tags a " \
+          "JOIN work_tags b ON b.work_id = a.work_id AND b.tag_id NOT IN (" + placeholders + ") " \
+          "JOIN tags t ON t.id = b.tag_id " \
+          "WHERE a.tag_id IN (" + placeholders + ") " \
+          "GROUP BY b.tag_id, t.type, t.name ORDER BY works DESC LIMIT %s"
+    cursor.execute(sql, tag_ids + tag_ids + [limit])
+    return cursor.fetchall()
+
+def backfill():
+    '''
+    fills tags and work_tags for works that don't have any rows there yet
+    '''
+    read_db = connect()
+    write_db = connect()
+    read_cursor = read_db.cursor()
+    write_cursor = write_db.cursor()
+
+    # the default cursor is unbuffered, so works are streamed rather than loaded at once
+    columns = ", ".join("`" + tag_type + "`" for tag_type in tag_types)
+    read_cursor.execute("SELECT id, " + columns + " FROM works "
+                        "WHERE NOT EXISTS (SELECT 1 FROM work_tags WHERE work_tags.work_id = works.id)")
+    done = 0
+    while True:
+        rows = read_cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            tags = [column.split(", ") if column else [] for column in row[1:]]
+            write_tags(write_cursor, row[0], tags)
+        write_db.commit()
+        done = done + len(rows)
+        print("Backfilled", done, "works")
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Count works in the fics database using a tag or its synonyms.')
+    parser.add_argument(
+        'tags', metavar='TAG', nargs='*',
+        help='one or more tag names, as written on AO3')
+    parser.add_argument(
+        '--cooccur', default=0,
+        help='also list this many tags most often used alongside each tag')
+    parser.add_argument(
+        '--no-synonyms', action='store_true',
+        help='count only the exact tag, not its wrangled synonyms')
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='refetch synonyms from AO3 instead of using the cache')
+    parser.add_argument(
+        '--backfill', action='store_true',
+        help='fill the tag tables from the works table first')
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.backfill:
+        backfill()
+
+    db = connect()
+    cursor = db.cursor()
+    for tag in args.tags:
+        if args.no_synonyms:
+            names = [unidecode(tag)]
+        else:
+            names = get_synonyms(db, cursor, tag, args.refresh)
+        tag_ids = get_tag_ids(cursor, names)
+        print(tag + ":", count_works(cursor, tag_ids), "works", "(" + str(len(names) - 1) + " synonyms)")
+
+        if int(args.cooccur):
+            for tag_type, name, works in cooccurring_tags(cursor, tag_ids, int(args.cooccur)):
+                print("   ", works, tag_type, name)
+
+if __name__ == '__main__':
+    main()
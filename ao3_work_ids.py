@@ -6,6 +6,8 @@
 # Only retrieve multichapter fics
 # Modify search to include a list of tags
 #      (e.g. you want all fics tagged either "romance" or "fluff")
+# Plan the tag crawl: probe each tag's result count first, crawl
+#      the biggest tags first and optionally merge small tags into one query
 
 from bs4 import BeautifulSoup
 import re
@@ -16,6 +18,8 @@ import sys
 import datetime
 import argparse
 import os
+import math
+from urllib.parse import quote
 
 page_empty = False
 base_url = ""
@@ -25,12 +29,24 @@ num_recorded_fic = 0
 csv_name = ""
 multichap_only = ""
 tags = []
+combine_below = 0
+
+# works AO3 lists on each page of results
+works_per_page = 20
+
+# bookkeeping for the tag crawl report:
+# every request made, and every eligible work listed on a page
+num_requests = 0
+num_listed = 0
 
 # keep track of all processed ids to avoid repeats:
 # this is separate from the temporary batch of ids
 # that are written to the csv and then forgotten
 seen_ids = set()
 
+# blurb stats of ids waiting to be written to the csv
+blurb_stats = {}
+
 # 
 # Ask the user for:
 # a url of a works listed page
@@ -50,6 +66,7 @@ def get_args():
     global num_requested_fic
     global multichap_only
     global tags
+    global combine_below
 
     parser = argparse.ArgumentParser(description='Scrape AO3 work IDs given a search URL')
     parser.add_argument(
@@ -70,9 +87,14 @@ def get_args():
     parser.add_argument(
         '--tag_csv', default='',
         help='provide an optional list of tags; the retrieved fics must have one or more such tags')
+    parser.add_argument(
+        '--combine_below', default=0,
+        help='with --tag_csv, merge tags with fewer than this many works into a single OR query (default off)')
 
     args = parser.parse_args()
     url = args.url
+    base_url = args.url
+    combine_below = int(args.combine_below)
     csv_name = str(args.out_csv)
     
     # defaults to all
@@ -99,23 +121,36 @@ def get_args():
     return header_info
 
 # 
-# navigate to a works listed page,
-# then extract all work ids
+# fetch the works listed page at the current url
 # 
-def get_ids(header_info=''):
-    global page_empty
-    global seen_ids
+def get_soup(header_info=''):
+    global num_requests
 
     # make the request. if we 429, try again later 
     headers = {'user-agent' : header_info}
     req = requests.get(url, headers=headers)
+    num_requests = num_requests + 1
     while req.status_code == 429:
         # >5 second delay between requests as per AO3's terms of service
         time.sleep(10)
         req = requests.get(url, headers=headers)
+        num_requests = num_requests + 1
         print("Request answered with Status-Code 429, retrying...")
 
-    soup = BeautifulSoup(req.text, "lxml")
+    return BeautifulSoup(req.text, "lxml")
+
+# 
+# navigate to a works listed page,
+# then extract all work ids.
+# a page that was already fetched (e.g. by a tag probe) can be passed in
+# 
+def get_ids(header_info='', soup=None):
+    global page_empty
+    global seen_ids
+    global num_listed
+
+    if soup is None:
+        soup = get_soup(header_info)
 
     # some responsiveness in the "UI"
     sys.stdout.write('.')
@@ -132,19 +167,50 @@ def get_ids(header_info=''):
             # FOR MULTICHAP ONLY
             chaps = tag.find('dd', class_="chapters")
             if (chaps.text != u"1/1"):
+                num_listed = num_listed + 1
                 t = tag.get('id')
                 t = t[5:]
                 if not t in seen_ids:
                     ids.append(t)
                     seen_ids.add(t)
+                    blurb_stats[t] = get_blurb_stats(tag)
         else:
+            num_listed = num_listed + 1
             t = tag.get('id')
             t = t[5:]
             if not t in seen_ids:
                 ids.append(t)
                 seen_ids.add(t)
+                blurb_stats[t] = get_blurb_stats(tag)
     return ids
 
+# 
+# words, chapters, kudos and last updated date (YYYY-MM-DD)
+# from a work's blurb on a works listed page,
+# written next to the id so ao3_get_fanfics.py can schedule by them
+# 
+def get_blurb_stats(blurb):
+    stats = []
+    for category in ['words', 'chapters', 'kudos']:
+        stat = blurb.find('dd', class_=category)
+        stats.append(stat.text.strip() if stat else '')
+    # chapters is "posted/planned", keep the posted count
+    stats[1] = stats[1].split('/')[0]
+    stats[0] = stats[0].replace(',', '')
+    stats[2] = stats[2].replace(',', '')
+
+    updated = blurb.find('p', class_='datetime')
+    try:
+        updated = datetime.datetime.strptime(updated.text.strip(), "%d %b %Y").strftime("%Y-%m-%d")
+    except (AttributeError, ValueError):
+        updated = ''
+    stats.append(updated)
+
+    # added after updated, so the columns of older csvs keep their place
+    bookmarks = blurb.find('dd', class_='bookmarks')
+    stats.append(bookmarks.text.strip().replace(',', '') if bookmarks else '')
+    return stats
+
 # 
 # update the url to move to the next page
 # note that if you go too far, ao3 won't error, 
@@ -182,14 +248,49 @@ def update_url_to_next_page():
 # modify the base_url to include the new tag, and save to global url
 def add_tag_to_url(tag):
     global url
+    tag = quote(tag, safe='')
     key = "&work_search%5Bother_tag_names%5D="
-    if (base_url.find(key)):
+    if (base_url.find(key) != -1):
         start = base_url.find(key) + len(key)
         new_url = base_url[:start] + tag + "%2C" + base_url[start:]
         url = new_url
     else:
         url = base_url + "&work_search%5Bother_tag_names%5D=" + tag
 
+# modify the base_url to match works with any of the given tags, and save to global url
+# other_tag_names is an AND filter, so the OR goes through the search query box instead
+def add_tag_group_to_url(group):
+    global url
+    query = quote(" OR ".join('tag:"' + t + '"' for t in group), safe='')
+    key = "&work_search%5Bquery%5D="
+    if (base_url.find(key) != -1):
+        start = base_url.find(key) + len(key)
+        end = base_url.find("&", start)
+        if (end == -1):
+            end = len(base_url)
+        existing = base_url[start:end]
+        if (existing):
+            query = "%28" + existing + "%29+AND+%28" + query + "%29"
+        url = base_url[:start] + query + base_url[end:]
+    else:
+        url = base_url + key + query
+
+# 
+# read the total result count from a works listed page,
+# e.g. "1 - 20 of 2,345 Works in Sherlock (TV)"
+# returns None if there's no such heading (markup change, error page, ...)
+# 
+def get_total_works(soup):
+    for heading in soup.find_all("h2", class_="heading"):
+        match = re.search(r"([\d,]+)\s+Works?\b", heading.text)
+        if (match):
+            return int(match.group(1).replace(",", ""))
+    return None
+
+# does a works listed page list any works at all
+def lists_works(soup):
+    return len(soup.select("li.work.blurb.group")) > 0
+
 
 # 
 # after every page, write the gathered ids
@@ -202,11 +303,11 @@ def write_ids_to_csv(ids):
     with open(csv_name + ".csv", 'a', newline="") as csvfile:
         wr = csv.writer(csvfile, delimiter=',')
         for id in ids:
+            # pop even if it isn't written, so unwritten ids don't pile up
+            stats = blurb_stats.pop(id, [])
             if (not_finished()):
-                wr.writerow([id, url])
+                wr.writerow([id, url] + stats)
                 num_recorded_fic = num_recorded_fic + 1
-            else:
-                break
 
 # 
 # if you want everything, you're not done
@@ -242,13 +343,141 @@ def reset():
     page_empty = False
     num_recorded_fic = 0
 
-def process_for_ids(header_info=''):
-    while(not_finished()):
+# 
+# total is the number of works the listing holds, if known.
+# paging stops after the last page it fills, instead of
+# requesting one more page to find it empty
+# 
+def process_for_ids(header_info='', first_page=None, total=None):
+    pages = 0
+    # reuse an already fetched first page instead of requesting it again
+    if (first_page is not None):
+        ids = get_ids(header_info, first_page)
+        write_ids_to_csv(ids)
+        update_url_to_next_page()
+        pages = 1
+
+    while(not_finished() and (total is None or pages < math.ceil(total / works_per_page))):
         # 5 second delay between requests as per AO3's terms of service
         time.sleep(5)
         ids = get_ids(header_info)
         write_ids_to_csv(ids)
         update_url_to_next_page()
+        pages = pages + 1
+
+# 
+# requests still needed for a listing of count works
+# whose first page has already been fetched
+# 
+def pages_after_first(count):
+    return max(0, math.ceil(count / works_per_page) - 1)
+
+# 
+# fetch the first page of every tag to learn its result count.
+# the page is kept so the crawl doesn't request it twice.
+# returns {tag: (count, first page)}
+# 
+def probe_tags(header_info=''):
+    probes = {}
+    for t in tags:
+        add_tag_to_url(t)
+        # 5 second delay between requests as per AO3's terms of service
+        time.sleep(5)
+        soup = get_soup(header_info)
+        probes[t] = (get_total_works(soup), soup)
+        if (probes[t][0] is None):
+            print("Tag", t, "has an unknown number of works")
+        else:
+            print("Tag", t, "has", probes[t][0], "works")
+    return probes
+
+# 
+# order the tags by result count, biggest first, so the later (smaller)
+# crawls are the ones that run into already seen ids.
+# tags whose count couldn't be read go first and are never combined.
+# tags with fewer than combine_below works are packed into OR groups
+# of at most combine_below works each. a tag whose probe page already
+# holds all its works costs nothing more, so it is never combined.
+# the first pages are already paid for, so a group only saves requests
+# when its tags share works: it is probed only if it could save pages
+# after the first even with the most overlap, and kept only if its
+# probe count looks like a union of its tags that does save pages.
+# otherwise its tags are crawled one at a time.
+# returns a list of (group of tags, first page)
+# 
+def plan_tag_crawl(probes, header_info=''):
+    ordered = sorted(probes, key=lambda t: float('inf') if probes[t][0] is None else probes[t][0], reverse=True)
+    # tags whose first page lists nothing cost nothing more to crawl
+    for t in ordered:
+        if (not lists_works(probes[t][1])):
+            print("Skipping tag", t, "- its first page lists no works")
+    ordered = [t for t in ordered if lists_works(probes[t][1])]
+
+    small = [t for t in ordered if probes[t][0] is not None and works_per_page < probes[t][0] < combine_below]
+    plan = [([t], probes[t][1]) for t in ordered if t not in small]
+
+    groups = []
+    for t in small:
+        if (groups and sum(probes[g][0] for g in groups[-1]) + probes[t][0] <= combine_below):
+            groups[-1].append(t)
+        else:
+            groups.append([t])
+
+    for group in groups:
+        counts = [probes[t][0] for t in group]
+        separate = sum(pages_after_first(c) for c in counts)
+        # the group's own first page is one more request
+        if (len(group) == 1 or 1 + pages_after_first(max(counts)) >= separate):
+            plan.extend(([t], probes[t][1]) for t in group)
+            continue
+        add_tag_group_to_url(group)
+        time.sleep(5)
+        soup = get_soup(header_info)
+        count = get_total_works(soup)
+        if (count is not None and max(counts) <= count <= sum(counts) and pages_after_first(count) < separate):
+            print("Combined", len(group), "tags into one query with", count, "works")
+            plan.append((group, soup))
+        else:
+            print("Combined query for", group, "returned", count, "works, saving nothing; crawling separately")
+            plan.extend(([t], probes[t][1]) for t in group)
+
+    return plan
+
+# 
+# crawl one planned group, then record what it cost and what it gained
+# 
+def crawl_tag_group(group, first_page, header_info=''):
+    requests_before = num_requests
+    listed_before = num_listed
+    seen_before = len(seen_ids)
+
+    reset()
+    if (len(group) == 1):
+        add_tag_to_url(group[0])
+    else:
+        add_tag_group_to_url(group)
+    process_for_ids(header_info, first_page, get_total_works(first_page))
+
+    listed = num_listed - listed_before
+    new_ids = len(seen_ids) - seen_before
+    # the first page was paid for by the probe, and is counted there
+    spent = num_requests - requests_before
+    return {
+        'tags': group,
+        'requests': spent,
+        'listed': listed,
+        'new_ids': new_ids,
+        'dup_rate': (listed - new_ids) / listed if listed else 0.0,
+    }
+
+def print_tag_report(report, probe_requests):
+    print("\nTag crawl report:")
+    print("probe requests (first pages and combined queries):", probe_requests)
+    for r in report:
+        print(" | ".join(r['tags']), "-", r['requests'], "more requests,", r['new_ids'], "new ids,",
+              "{:.0%} duplicates".format(r['dup_rate']))
+    total_new = sum(r['new_ids'] for r in report)
+    print("total:", num_requests, "requests,", total_new, "new ids")
 
 def load_existing_ids():
     global seen_ids
@@ -273,11 +502,15 @@ def main():
 
 
     if (len(tags)):
-        for t in tags:
-            print ("Getting tag: ", t)
-            reset()
-            add_tag_to_url(t)
-            process_for_ids(header_info)
+        probes = probe_tags(header_info)
+        plan = plan_tag_crawl(probes, header_info)
+        probe_requests = num_requests
+
+        report = []
+        for group, first_page in plan:
+            print ("Getting tag: ", " OR ".join(group))
+            report.append(crawl_tag_group(group, first_page, header_info))
+        print_tag_report(report, probe_requests)
     else:
         process_for_ids(header_info)
 